@@ -15,64 +15,430 @@
 
 """Profiler utilities for Watcher audit operations."""
 
+import collections
+import contextvars
 import functools
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+import zlib
 
-import psutil
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import reflection
+from osprofiler import notifier
 from osprofiler import profiler
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
+# psutil is only imported once memory is actually tracked, so that services
+# running with profiling disabled don't load it.
+_PSUTIL = None
+_PROCESS = None
+
+# On Linux the RSS is read straight from /proc/self/statm, through a file
+# descriptor kept open and reopened after a fork since it refers to the
+# process which opened it. Other platforms go through psutil.
+_USE_STATM = sys.platform.startswith('linux')
+_PAGESIZE = os.sysconf('SC_PAGESIZE') if _USE_STATM else None
+_STATM_FD = None
+_STATM_PID = None
+
+# Values of the [profiler] options, cached to keep oslo.config lookups off
+# the traced code path. They are loaded on first use, once the
+# configuration files have been parsed, and reloaded when the configuration
+# is mutated. _CONF_GENERATION is bumped on every load so that wrappers can
+# tell when to re-evaluate their implementation.
+_CONF_GENERATION = 0
+_ENABLED = False
+_TRACE_MEM = False
+_SAMPLE_RATES = {}
+_DEFAULT_SAMPLE_RATE = 1.0
+_SAMPLE_INTERVAL = 0.5
+
+
+def _load_conf():
+    """Load the [profiler] options into the module level cache."""
+    global _CONF_GENERATION, _ENABLED, _TRACE_MEM, _SAMPLE_INTERVAL
+    global _SAMPLE_RATES, _DEFAULT_SAMPLE_RATE
+    rates = {}
+    for name, rate in CONF.profiler.trace_memory_sample_rates.items():
+        try:
+            rates[name] = float(rate)
+        except ValueError:
+            LOG.warning("Invalid memory sample rate %(rate)s for %(name)s, "
+                        "tracking all calls", {'rate': rate, 'name': name})
+            rates[name] = 1.0
+    _ENABLED = CONF.profiler.enabled
+    _TRACE_MEM = CONF.profiler.trace_memory_usage
+    _SAMPLE_INTERVAL = CONF.profiler.memory_sample_interval
+    _DEFAULT_SAMPLE_RATE = rates.get('default', 1.0)
+    _SAMPLE_RATES = rates
+    _CONF_GENERATION += 1
+
+
+def _ensure_conf():
+    if not _CONF_GENERATION:
+        _load_conf()
+
+
+def _on_conf_mutate(conf, fresh):
+    _load_conf()
+
+
+CONF.register_mutate_hook(_on_conf_mutate)
+
+
+def _psutil():
+    """Return the psutil module, importing it on first use."""
+    global _PSUTIL
+    if _PSUTIL is None:
+        import psutil
+        _PSUTIL = psutil
+    return _PSUTIL
+
+
+def _get_process():
+    """Return a cached psutil handle on the current process.
+
+    Building a ``psutil.Process`` reads ``/proc`` to validate the pid, so
+    the handle is shared by all trackers. It is rebuilt after a fork so
+    that child workers report their own memory rather than the parent's.
+    """
+    global _PROCESS
+    if _PROCESS is None or _PROCESS.pid != os.getpid():
+        _PROCESS = _psutil().Process()
+    return _PROCESS
+
+
+def _read_statm_rss():
+    global _STATM_FD, _STATM_PID
+    pid = os.getpid()
+    if _STATM_PID != pid:
+        if _STATM_FD is not None:
+            os.close(_STATM_FD)
+        _STATM_FD = os.open('/proc/self/statm', os.O_RDONLY)
+        _STATM_PID = pid
+    # The second field is the number of resident pages
+    return int(os.pread(_STATM_FD, 64, 0).split(None, 2)[1]) * _PAGESIZE
+
+
+def _read_rss():
+    """Return the resident set size of the current process in bytes."""
+    if _USE_STATM:
+        return _read_statm_rss()
+    return _get_process().memory_info().rss
+
+
+def _rss_errors():
+    if _USE_STATM:
+        return (OSError, ValueError, IndexError)
+    psutil = _psutil()
+    return (psutil.NoSuchProcess, psutil.AccessDenied)
+
+
+def _safe_read_rss():
+    """Read the resident set size, returning None if it is not readable."""
+    try:
+        return _read_rss()
+    except _rss_errors() as e:
+        LOG.warning("Failed to read memory usage: %s", e)
+        return None
+
+
+class _MemorySampler:
+    """Background thread sampling the memory usage of the process.
+
+    Active trackers register themselves with the sampler, which reads the
+    RSS once per ``[profiler]memory_sample_interval`` and raises the peak
+    of every registered tracker accordingly. The thread only runs while at
+    least one tracker is registered.
+
+    Under eventlet the thread is a green thread that only gets to run when
+    the traced code yields, so the last sample may be arbitrarily old: it
+    is only used as a baseline when it was taken within the interval.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trackers = weakref.WeakSet()
+        self._thread = None
+        self._pid = None
+        self.current = None
+        self._sampled_at = None
+
+    def register(self, tracker):
+        """Register a tracker and return the current RSS as its baseline.
+
+        :returns: the baseline in bytes, or None if the memory usage can't
+                  be read, in which case the tracker is not registered
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # The sampling thread does not survive a fork
+                self._pid = os.getpid()
+                self._thread = None
+            now = time.monotonic()
+            if (self._thread is None or
+                    now - self._sampled_at > _SAMPLE_INTERVAL):
+                rss = _safe_read_rss()
+                if rss is not None:
+                    self.current = rss
+                    self._sampled_at = now
+                elif self._thread is None:
+                    return None
+            if self._thread is None:
+                thread = threading.Thread(
+                    target=self._run, name="watcher-memory-sampler",
+                    daemon=True)
+                thread.start()
+                self._thread = thread
+            self._trackers.add(tracker)
+            return self.current
+
+    def unregister(self, tracker):
+        with self._lock:
+            self._trackers.discard(tracker)
+
+    def _run(self):
+        while True:
+            time.sleep(_SAMPLE_INTERVAL)
+            with self._lock:
+                if not self._trackers:
+                    self._thread = None
+                    return
+                trackers = list(self._trackers)
+            rss = _safe_read_rss()
+            if rss is None:
+                continue
+            self.current = rss
+            self._sampled_at = time.monotonic()
+            for tracker in trackers:
+                if tracker.mem_peak is None or rss > tracker.mem_peak:
+                    tracker.mem_peak = rss
+
+
+_SAMPLER = _MemorySampler()
+
+
+class _TraceEmitter:
+    """osprofiler notifier delivering trace points from a background thread.
+
+    osprofiler keeps its trace stack in thread local storage, so spans are
+    still started and stopped by the traced thread. Only the delivery of
+    the resulting notifications to the configured driver is deferred:
+    callers append to a deque, which needs no lock, and wake up a daemon
+    thread draining it. Notifications are dropped, and the drops logged,
+    once ``MAX_PENDING`` of them are waiting.
+
+    :meth:`flush` may also be called by the service when stopping, it is
+    serialized with the background thread so that notifications are still
+    delivered in order.
+    """
+
+    MAX_PENDING = 10000
+
+    def __init__(self, notify):
+        self._notify = notify
+        self._pending = collections.deque()
+        self._wakeup = threading.Event()
+        self._dropped = 0
+        self._flush_lock = threading.Lock()
+        self._thread = self._start_thread()
+
+    def _start_thread(self):
+        thread = threading.Thread(
+            target=self._run, name="watcher-trace-emitter", daemon=True)
+        thread.start()
+        return thread
+
+    def __call__(self, payload):
+        if len(self._pending) >= self.MAX_PENDING:
+            self._dropped += 1
+            return
+        self._pending.append(payload)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Deliver all the pending notifications."""
+        with self._flush_lock:
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                LOG.warning("Dropped %d profiler notifications, more than %d "
+                            "were pending", dropped, self.MAX_PENDING)
+            while True:
+                try:
+                    payload = self._pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    self._notify(payload)
+                except Exception as e:
+                    LOG.warning("Failed to emit profiler trace: %s", e)
+
+
+_EMITTER = None
+
+
+def enable_deferred_emission():
+    """Deliver osprofiler notifications outside of the traced code path.
+
+    Must be called after osprofiler has been initialized, as it wraps the
+    notifier configured by ``osprofiler.initializer.init_from_conf``.
+    """
+    global _EMITTER
+    current = notifier.get()
+    if not isinstance(current, _TraceEmitter):
+        _EMITTER = _TraceEmitter(current)
+        notifier.set(_EMITTER)
+
+
+def flush_deferred_emission():
+    """Deliver the notifications still pending, e.g. before stopping."""
+    if _EMITTER is not None:
+        _EMITTER.flush()
+
+
+# Audit of the innermost traced call bound to one in the current context
+_AUDIT_ID = contextvars.ContextVar('watcher_audit_id', default=None)
+
+# Stack of the trackers active in the current thread
+_LOCAL = threading.local()
+
+
+def _active_trackers():
+    try:
+        return _LOCAL.trackers
+    except AttributeError:
+        _LOCAL.trackers = []
+        return _LOCAL.trackers
+
 
 class MemoryTracker:
-    """Context manager for tracking memory usage during operations."""
+    """Context manager tracing an operation along with its memory usage.
+
+    The osprofiler trace point is started on enter and stopped on exit, with
+    the memory metrics attached to the stop notification, so that timing
+    and memory are recorded by a single context manager.
+
+    Trackers nested in another tracker of the same thread don't emit trace
+    points of their own: their info, metrics and duration are added to the
+    ``children`` list of the outermost tracker, which reports them all at
+    once when it stops.
+    """
 
-    def __init__(self, trace_name, audit_id=None):
+    # __weakref__ is needed by the sampler, which holds trackers weakly
+    __slots__ = ('trace_name', 'audit_id', 'info', 'track_memory',
+                 'mem_baseline', 'mem_peak', 'parent', 'children',
+                 'started_at', '__weakref__')
+
+    def __init__(self, trace_name, audit_id=None, info=None,
+                 track_memory=True):
         """Initialize memory tracker.
 
         :param trace_name: Name for the profiler trace point
         :param audit_id: Optional audit UUID for correlation
+        :param info: Optional dict with trace metadata
+        :param track_memory: Whether to collect memory metrics, in addition
+                             to ``[profiler]trace_memory_usage``
         """
+        _ensure_conf()
         self.trace_name = trace_name
         self.audit_id = audit_id
-        self.process = psutil.Process()
+        self.info = info
+        self.track_memory = track_memory and _TRACE_MEM
         self.mem_baseline = None
         self.mem_peak = None
+        self.parent = None
+        self.children = []
+        self.started_at = None
 
     def __enter__(self):
-        """Capture baseline memory on enter."""
-        if CONF.profiler.trace_memory_usage:
-            try:
-                self.mem_baseline = self.process.memory_info().rss / 1024 / 1024  # MB
-            except Exception as e:
-                LOG.warning("Failed to capture baseline memory: %s", e)
-                self.mem_baseline = None
+        """Start the trace point and record the baseline memory."""
+        if self.track_memory:
+            self.mem_baseline = self.mem_peak = _SAMPLER.register(self)
+        # Only pushed once nothing else can fail, a tracker left on the
+        # stack would swallow the trace points of all the following ones
+        trackers = _active_trackers()
+        if trackers:
+            self.parent = trackers[-1]
+            self.started_at = time.monotonic()
+        else:
+            profiler.start(self.trace_name, info=self.info)
+        trackers.append(self)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Capture peak memory and attach to trace on exit."""
-        if CONF.profiler.trace_memory_usage and self.mem_baseline is not None:
-            try:
-                self.mem_peak = self.process.memory_info().rss / 1024 / 1024  # MB
-                mem_delta = self.mem_peak - self.mem_baseline
-
-                # Attach memory metrics to current trace
-                profiler.stop({
-                    "memory_baseline_mb": self.mem_baseline,
-                    "memory_peak_mb": self.mem_peak,
-                    "memory_delta_mb": mem_delta,
-                    "audit_id": str(self.audit_id) if self.audit_id else None
-                })
-            except Exception as e:
-                LOG.warning("Failed to capture peak memory: %s", e)
+        """Stop the trace point, attaching the peak memory to it."""
+        _active_trackers().pop()
+        if self.mem_baseline is not None:
+            _SAMPLER.unregister(self)
+            # Calls shorter than the sampling interval, or not yielding to
+            # the sampler, would otherwise never see a sample of their own
+            rss = _safe_read_rss()
+            if rss is not None and rss > self.mem_peak:
+                self.mem_peak = rss
+        error = None
+        if exc_type is not None:
+            error = (reflection.get_class_name(exc_type), str(exc_val))
+
+        stop_info = _build_stop_info(self.mem_baseline, self.mem_peak,
+                                     self.audit_id, error, self.children)
+        if self.parent is not None:
+            stop_info["name"] = self.trace_name
+            if self.info:
+                stop_info["info"] = self.info
+            stop_info["duration"] = time.monotonic() - self.started_at
+            self.parent.children.append(stop_info)
+            return False
+
+        try:
+            profiler.stop(stop_info or None)
+        except Exception as e:
+            LOG.warning("Failed to stop profiler trace: %s", e)
 
         return False  # Don't suppress exceptions
 
 
+def _build_stop_info(baseline, peak, audit_id, error, children):
+    """Build the stop notification info of a tracker.
+
+    :param baseline: Baseline memory in bytes, None if not tracked
+    :param peak: Peak memory in bytes
+    :param audit_id: Optional audit UUID
+    :param error: Optional (exception type name, message) tuple
+    :param children: Stop info of the nested trackers
+    """
+    stop_info = {}
+    if baseline is not None:
+        if audit_id is not None and not isinstance(audit_id, str):
+            audit_id = str(audit_id)
+        stop_info = {
+            "memory_baseline_bytes": baseline,
+            "memory_peak_bytes": peak,
+            "memory_delta_bytes": peak - baseline,
+            "audit_id": audit_id or None
+        }
+    if error is not None:
+        stop_info["etype"], stop_info["message"] = error
+    if children:
+        stop_info["children"] = children
+    return stop_info
+
+
 def trace_with_memory(name, info=None):
-    """Decorator combining @profiler.trace() with memory tracking.
+    """Decorator tracing a function along with its memory usage.
 
     Usage:
         @trace_with_memory("watcher-audit-execute",
@@ -81,32 +447,110 @@ def trace_with_memory(name, info=None):
             # Your code here
             pass
 
+    Calls whose info doesn't provide an ``audit_id`` are attributed to the
+    audit of the traced call they are nested in, if any.
+
     :param name: Trace point name (e.g., "watcher-audit-execute")
     :param info: Dict or callable returning dict with trace metadata
     """
     def decorator(func):
-        # First apply osprofiler decorator for timing
-        traced_func = profiler.trace(name, info=info)(func)
+        func_name = reflection.get_callable_name(func)
 
-        @functools.wraps(traced_func)
-        def wrapper(*args, **kwargs):
-            # Extract audit_id if available
-            audit_id = None
-            if info and callable(info):
+        if callable(info):
+            def traced_func(*args, **kwargs):
+                # Resolve the trace metadata and extract audit_id if
+                # available
                 try:
                     metadata = info(*args, **kwargs)
-                    audit_id = metadata.get('audit_id')
                 except Exception:
-                    pass
+                    metadata = None
+                audit_id = metadata.get('audit_id') if metadata else None
+                return _traced_call(name, func, func_name, args, kwargs,
+                                    audit_id, metadata)
+        else:
+            # The audit_id of a constant info dict is resolved once here
+            # rather than per call
+            static_audit_id = info.get('audit_id') if info else None
+
+            def traced_func(*args, **kwargs):
+                return _traced_call(name, func, func_name, args, kwargs,
+                                    static_audit_id, info)
+
+        # The configuration is only parsed once the service starts, after
+        # this decorator has run, so the implementation is picked on the
+        # first call and reused until the configuration is reloaded.
+        # state holds the configuration generation and the implementation.
+        state = [None, None]
 
-            # Execute with memory tracking
-            with MemoryTracker(name, audit_id):
-                return traced_func(*args, **kwargs)
+        def select():
+            _ensure_conf()
+            # Memory metrics are only reported through osprofiler traces,
+            # so nothing is collected when it is disabled
+            state[1] = traced_func if _ENABLED else func
+            state[0] = _CONF_GENERATION
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if state[0] != _CONF_GENERATION:
+                select()
+            return state[1](*args, **kwargs)
 
         return wrapper
     return decorator
 
 
+def _traced_call(name, func, func_name, args, kwargs, audit_id,
+                 metadata=None):
+    """Call func within a MemoryTracker.
+
+    The trace point info gets the same function details as the ones added by
+    osprofiler's trace decorator. Calls without an audit id of their own are
+    attributed to the audit of the traced call they are nested in, if any.
+    """
+    token = None
+    outer_audit_id = _AUDIT_ID.get()
+    if audit_id is None:
+        audit_id = outer_audit_id
+    elif audit_id != outer_audit_id:
+        token = _AUDIT_ID.set(audit_id)
+    track_memory = _TRACE_MEM and _is_sampled(name, audit_id)
+    # Always a new dict, osprofiler adds the host to the info it gets
+    info = dict(metadata) if metadata else {}
+    info["function"] = {
+        "name": func_name, "args": str(args), "kwargs": str(kwargs)}
+    try:
+        with MemoryTracker(name, audit_id, info=info,
+                           track_memory=track_memory):
+            return func(*args, **kwargs)
+    finally:
+        if token is not None:
+            _AUDIT_ID.reset(token)
+
+
+def _is_sampled(name, audit_id=None):
+    """Tell whether memory should be tracked for this call.
+
+    The rate is looked up in ``[profiler]trace_memory_sample_rates`` by
+    trace point name, falling back to the ``default`` entry. Calls bound to
+    an audit are sampled on a hash of the audit UUID, so that all the trace
+    points of a given audit are either tracked or skipped together.
+
+    :param name: Trace point name
+    :param audit_id: Optional audit UUID
+    """
+    _ensure_conf()
+    rate = _SAMPLE_RATES.get(name, _DEFAULT_SAMPLE_RATE)
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0:
+        return False
+    if audit_id is not None:
+        bucket = zlib.crc32(str(audit_id).encode()) & 0xffff
+        return bucket < rate * 0x10000
+    return random.random() < rate
+
+
 def is_profiling_enabled():
     """Check if profiling is currently enabled."""
-    return CONF.profiler.enabled and profiler.get() is not None
+    _ensure_conf()
+    return _ENABLED and profiler.get() is not None
@@ -40,6 +40,7 @@ from watcher.conf import nova_client
 from watcher.conf import paths
 from watcher.conf import placement_client
 from watcher.conf import planner
+from watcher.conf import profiler
 from watcher.conf import prometheus_client
 from watcher.conf import service
 
@@ -69,3 +70,4 @@ ironic_client.register_opts(CONF)
 collector.register_opts(CONF)
 placement_client.register_opts(CONF)
 prometheus_client.register_opts(CONF)
+profiler.register_opts(CONF)
@@ -39,10 +39,33 @@ profiler_opts_list = [
     cfg.BoolOpt(
         'trace_memory_usage',
         default=True,
+        mutable=True,
         help='Enable memory usage tracking during audit operations. '
              'When enabled, memory metrics (baseline, peak, delta) will '
              'be captured and attached to profiling traces.'
     ),
+    cfg.DictOpt(
+        'trace_memory_sample_rates',
+        default={'default': 1.0},
+        mutable=True,
+        help='Fraction of the calls, between 0.0 and 1.0, for which memory '
+             'usage is tracked, keyed by trace point name. Trace points '
+             'without an entry use the "default" rate. Calls bound to an '
+             'audit are sampled per audit, so that all the trace points of '
+             'a sampled audit are tracked. Only used when '
+             'trace_memory_usage is enabled. '
+             'Example: default:0.1,watcher-audit-execute:1.0'
+    ),
+    cfg.FloatOpt(
+        'memory_sample_interval',
+        default=0.5,
+        mutable=True,
+        min=0.01,
+        help='Interval in seconds between two samples of the process '
+             'memory usage while memory tracking is active. The peak '
+             'memory reported for a trace is the highest sampled value, '
+             'so lower values are more accurate but more expensive.'
+    ),
 ]
 
 
@@ -55,6 +78,4 @@ def register_opts(conf):
 
 def list_opts():
     """List profiler configuration options for sample config generation."""
-    return {
-        profiler_group: profiler_opts_list
-    }
+    return [(profiler_group, profiler_opts_list)]
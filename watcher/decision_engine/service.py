@@ -16,9 +16,9 @@ import socket
 
 from oslo_config import cfg
 from oslo_log import log
-from osprofiler import initializer as osprofiler_initializer
 
 from watcher.common import context
+from watcher.common import profiler as watcher_profiler
 from watcher.common import service as watcher_service
 from watcher.decision_engine.audit import continuous as c_handler
 from watcher.decision_engine import manager
@@ -27,6 +27,8 @@ from watcher.decision_engine import scheduling
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
+_HOSTNAME = socket.gethostname()
+
 
 class DecisionEngineService(watcher_service.Service):
     """Decision Engine Service that runs on a host.
@@ -62,14 +64,17 @@ class DecisionEngineService(watcher_service.Service):
 
         # Initialize osprofiler if enabled
         if CONF.profiler.enabled:
+            from osprofiler import initializer as osprofiler_initializer
+
             try:
                 osprofiler_initializer.init_from_conf(
                     conf=CONF,
                     context=context.get_admin_context().to_dict(),
                     project="watcher",
                     service="decision-engine",
-                    host=socket.gethostname()
+                    host=_HOSTNAME
                 )
+                watcher_profiler.enable_deferred_emission()
                 LOG.info("OSProfiler initialized successfully for decision engine")
             except Exception as e:
                 LOG.warning("Failed to initialize osprofiler: %s. "
@@ -82,6 +87,7 @@ class DecisionEngineService(watcher_service.Service):
         """Stop service."""
         super().stop()
         self.bg_scheduler.stop()
+        watcher_profiler.flush_deferred_emission()
 
     def wait(self):
         """Wait for service to complete."""
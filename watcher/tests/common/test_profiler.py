@@ -0,0 +1,541 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import functools
+import sys
+import time
+import unittest
+from unittest import mock
+import uuid
+
+import fixtures
+from oslo_utils import reflection
+import psutil
+
+from watcher.common import exception
+from watcher.common import profiler
+from watcher.tests import base
+
+
+class ProfilerTestCase(base.TestCase):
+    """Test case isolating the cached [profiler] options.
+
+    The options are cached in module globals, which would otherwise outlive
+    the configuration fixture and leak into the following tests.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for name in ('_ENABLED', '_TRACE_MEM', '_SAMPLE_RATES',
+                     '_DEFAULT_SAMPLE_RATE', '_SAMPLE_INTERVAL'):
+            self.useFixture(fixtures.MockPatchObject(
+                profiler, name, getattr(profiler, name)))
+        # Force the options to be loaded again from the test configuration
+        self.useFixture(fixtures.MockPatchObject(
+            profiler, '_CONF_GENERATION', 0))
+
+    def config(self, **kw):
+        super().config(**kw)
+        profiler._load_conf()
+
+
+class TestConfCache(ProfilerTestCase):
+
+    def test_loaded_on_first_use(self):
+        self.assertEqual(0, profiler._CONF_GENERATION)
+        self.assertTrue(profiler._is_sampled("watcher-audit-execute"))
+        self.assertEqual(1, profiler._CONF_GENERATION)
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_mutate_hook_reloads_conf(self, m_profiler):
+        @profiler.trace_with_memory("watcher-test")
+        def execute():
+            return mock.sentinel.result
+
+        self.assertEqual(mock.sentinel.result, execute())
+        self.assertFalse(profiler._ENABLED)
+        self.assertEqual([], m_profiler.method_calls)
+
+        # Change the options without going through the overridden config()
+        # helper, which would reload them
+        profiler.CONF.set_override('enabled', True, group='profiler')
+        profiler.CONF.set_override('memory_sample_interval', 2.0,
+                                   group='profiler')
+        profiler._on_conf_mutate(profiler.CONF, {})
+
+        self.assertTrue(profiler._ENABLED)
+        self.assertEqual(2.0, profiler._SAMPLE_INTERVAL)
+        self.assertEqual(mock.sentinel.result, execute())
+        m_profiler.start.assert_called_once_with(
+            "watcher-test", info=mock.ANY)
+
+
+class TestMemorySampling(ProfilerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        profiler._load_conf()
+
+    def test_sampled_by_default(self):
+        self.assertTrue(profiler._is_sampled("watcher-audit-execute"))
+
+    def test_rate_by_trace_name(self):
+        self.config(trace_memory_sample_rates={
+            'default': '1.0', 'watcher-audit-execute': '0.0'},
+            group='profiler')
+        self.assertFalse(profiler._is_sampled("watcher-audit-execute"))
+        self.assertTrue(profiler._is_sampled("watcher-other"))
+
+    def test_default_rate(self):
+        self.config(trace_memory_sample_rates={'default': '0.0'},
+                    group='profiler')
+        self.assertFalse(profiler._is_sampled("watcher-audit-execute"))
+
+    def test_invalid_rate(self):
+        self.config(trace_memory_sample_rates={'default': 'foo'},
+                    group='profiler')
+        self.assertTrue(profiler._is_sampled("watcher-audit-execute"))
+
+    @mock.patch.object(profiler.random, 'random')
+    def test_random_sampling(self, m_random):
+        self.config(trace_memory_sample_rates={'default': '0.5'},
+                    group='profiler')
+        m_random.return_value = 0.2
+        self.assertTrue(profiler._is_sampled("watcher-audit-execute"))
+        m_random.return_value = 0.7
+        self.assertFalse(profiler._is_sampled("watcher-audit-execute"))
+
+    @mock.patch.object(profiler.random, 'random')
+    def test_audit_sampling_is_consistent(self, m_random):
+        self.config(trace_memory_sample_rates={'default': '0.5'},
+                    group='profiler')
+        audit_id = "a4b4cd4c-5e4c-4a4f-9c3b-0a0d2c4e7b8e"
+        sampled = profiler._is_sampled("watcher-audit-execute", audit_id)
+        for _ in range(10):
+            self.assertEqual(
+                sampled,
+                profiler._is_sampled("watcher-audit-pre-execute", audit_id))
+        m_random.assert_not_called()
+
+
+class TestReadRss(base.TestCase):
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+                         "/proc/self/statm is only available on Linux")
+    def test_read_statm_rss(self):
+        rss = profiler._read_statm_rss()
+        # Both values are read at different times, allow for some drift
+        expected = psutil.Process().memory_info().rss
+        self.assertAlmostEqual(expected, rss, delta=expected * 0.1)
+
+    @mock.patch.object(profiler, '_USE_STATM', False)
+    def test_read_rss_psutil(self):
+        self.assertGreater(profiler._read_rss(), 0)
+
+    @mock.patch.object(profiler, '_read_rss', side_effect=OSError)
+    @mock.patch.object(profiler, '_USE_STATM', True)
+    def test_safe_read_rss_error(self, m_read_rss):
+        self.assertIsNone(profiler._safe_read_rss())
+
+
+class TestMemoryTracker(ProfilerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config(memory_sample_interval=0.01, group='profiler')
+        self.sampler = profiler._MemorySampler()
+        self.useFixture(fixtures.MockPatchObject(
+            profiler, '_SAMPLER', self.sampler))
+        self.m_read_rss = self.useFixture(fixtures.MockPatchObject(
+            profiler, '_safe_read_rss', return_value=1000)).mock
+
+    def _wait_for(self, predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            time.sleep(0.01)
+        self.fail("Timed out waiting for the memory sampler")
+
+    def _stop_sampler(self, *trackers):
+        thread = self.sampler._thread
+        for tracker in trackers:
+            self.sampler.unregister(tracker)
+        if thread is not None:
+            thread.join(2)
+        self.assertIsNone(self.sampler._thread)
+
+    def test_sampler_starts_on_register(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        self.assertIsNone(self.sampler._thread)
+
+        self.assertEqual(1000, self.sampler.register(tracker))
+        self.assertTrue(self.sampler._thread.is_alive())
+        self._stop_sampler(tracker)
+
+    def test_sampler_stops_without_trackers(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        self.sampler.register(tracker)
+        thread = self.sampler._thread
+        self.sampler.unregister(tracker)
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.sampler._thread)
+
+        # A new thread is started for the next tracker
+        self.sampler.register(tracker)
+        self.assertIsNot(thread, self.sampler._thread)
+        self._stop_sampler(tracker)
+
+    def test_sampler_raises_peak(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        self.m_read_rss.return_value = 1000
+        tracker.mem_peak = self.sampler.register(tracker)
+        self.m_read_rss.return_value = 3000
+        self._wait_for(lambda: tracker.mem_peak == 3000)
+        self.m_read_rss.return_value = 2000
+        self._wait_for(lambda: self.sampler.current == 2000)
+        self.assertEqual(3000, tracker.mem_peak)
+        self._stop_sampler(tracker)
+
+    def test_sampler_restarts_after_fork(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        # Thread inherited from the parent process, which doesn't run here
+        self.sampler._pid = -1
+        self.sampler._thread = mock.Mock()
+
+        self.sampler.register(tracker)
+        self.assertIsInstance(self.sampler._thread, profiler.threading.Thread)
+        self.assertEqual(profiler.os.getpid(), self.sampler._pid)
+        self._stop_sampler(tracker)
+
+    def test_sampler_fresh_baseline(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        # Running thread which last sampled 1000 bytes
+        self.sampler._pid = profiler.os.getpid()
+        self.sampler._thread = mock.Mock()
+        self.sampler.current = 1000
+        self.sampler._sampled_at = time.monotonic()
+        self.m_read_rss.return_value = 2000
+
+        # The last sample is recent enough to be used as a baseline
+        self.config(memory_sample_interval=60, group='profiler')
+        self.assertEqual(1000, self.sampler.register(tracker))
+        self.m_read_rss.assert_not_called()
+
+        # But not once it is older than the interval
+        self.sampler._sampled_at -= 61
+        self.assertEqual(2000, self.sampler.register(tracker))
+        self.assertEqual(2000, self.sampler.current)
+
+    def test_sampler_read_error(self):
+        tracker = profiler.MemoryTracker("watcher-test")
+        self.m_read_rss.return_value = None
+        self.assertIsNone(self.sampler.register(tracker))
+        self.assertIsNone(self.sampler._thread)
+        self.assertEqual(0, len(self.sampler._trackers))
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_register_error(self, m_profiler):
+        tracker = profiler.MemoryTracker("watcher-test")
+        with mock.patch.object(self.sampler, 'register',
+                               side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, tracker.__enter__)
+        self.assertEqual([], profiler._active_trackers())
+        m_profiler.start.assert_not_called()
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_tracker(self, m_profiler):
+        with profiler.MemoryTracker("watcher-test", info={"foo": "bar"},
+                                    track_memory=False):
+            pass
+        m_profiler.start.assert_called_once_with(
+            "watcher-test", info={"foo": "bar"})
+        m_profiler.stop.assert_called_once_with(None)
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_stop_payload(self, m_profiler):
+        with mock.patch.object(self.sampler, 'register',
+                               side_effect=[1000, 1500]):
+            with profiler.MemoryTracker("watcher-parent",
+                                        "fake_uuid") as parent:
+                with profiler.MemoryTracker("watcher-child",
+                                            "fake_uuid") as child:
+                    child.mem_peak = 2048
+                parent.mem_peak = 4096
+
+        m_profiler.start.assert_called_once_with(
+            "watcher-parent", info=None)
+        stop_info = m_profiler.stop.call_args[0][0]
+        self.assertIsInstance(stop_info["children"][0].pop("duration"),
+                              float)
+        self.assertEqual({
+            "memory_baseline_bytes": 1000,
+            "memory_peak_bytes": 4096,
+            "memory_delta_bytes": 3096,
+            "audit_id": "fake_uuid",
+            "children": [{
+                "name": "watcher-child",
+                "memory_baseline_bytes": 1500,
+                "memory_peak_bytes": 2048,
+                "memory_delta_bytes": 548,
+                "audit_id": "fake_uuid",
+            }],
+        }, stop_info)
+        self.assertIsInstance(stop_info["memory_delta_bytes"], int)
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_exit_read_raises_peak(self, m_profiler):
+        with mock.patch.object(self.sampler, 'register', return_value=1000):
+            with profiler.MemoryTracker("watcher-test", "fake_uuid"):
+                self.m_read_rss.return_value = 5000
+
+        m_profiler.stop.assert_called_once_with({
+            "memory_baseline_bytes": 1000,
+            "memory_peak_bytes": 5000,
+            "memory_delta_bytes": 4000,
+            "audit_id": "fake_uuid",
+        })
+
+    def test_stop_info_string_audit_id(self):
+        class AuditId(str):
+            pass
+
+        # str() would return a plain str copy of the subclass instance
+        audit_id = AuditId("fake_uuid")
+        stop_info = profiler._build_stop_info(1, 2, audit_id, None, [])
+        self.assertIs(audit_id, stop_info["audit_id"])
+
+    def test_stop_info_uuid_audit_id(self):
+        audit_id = uuid.uuid4()
+        stop_info = profiler._build_stop_info(1, 2, audit_id, None, [])
+        self.assertEqual(str(audit_id), stop_info["audit_id"])
+        self.assertIsInstance(stop_info["audit_id"], str)
+
+    def test_stop_info_no_audit_id(self):
+        stop_info = profiler._build_stop_info(1, 2, "", None, [])
+        self.assertIsNone(stop_info["audit_id"])
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_nested_trackers(self, m_profiler):
+        with profiler.MemoryTracker("watcher-parent", track_memory=False):
+            with profiler.MemoryTracker("watcher-child", info={"key": "v"},
+                                        track_memory=False):
+                pass
+        m_profiler.start.assert_called_once_with(
+            "watcher-parent", info=None)
+        m_profiler.stop.assert_called_once_with({
+            "children": [{
+                "name": "watcher-child",
+                "info": {"key": "v"},
+                "duration": mock.ANY,
+            }],
+        })
+
+
+class TestTraceWithMemoryDisabled(ProfilerTestCase):
+
+    @mock.patch.object(profiler, 'MemoryTracker')
+    @mock.patch.object(profiler, 'profiler')
+    def test_profiling_disabled(self, m_profiler, m_tracker):
+        info = mock.Mock()
+
+        @profiler.trace_with_memory("watcher-test", info=info)
+        def execute(audit):
+            return audit
+
+        self.assertEqual(mock.sentinel.audit, execute(mock.sentinel.audit))
+        self.assertEqual([], m_profiler.method_calls)
+        m_tracker.assert_not_called()
+        info.assert_not_called()
+
+    @mock.patch.object(profiler, 'MemoryTracker')
+    def test_implementation_reselected(self, m_tracker):
+        @profiler.trace_with_memory("watcher-test")
+        def execute(audit):
+            return audit
+
+        execute(mock.sentinel.audit)
+        m_tracker.assert_not_called()
+
+        # Bumps _CONF_GENERATION
+        self.config(enabled=True, group='profiler')
+        execute(mock.sentinel.audit)
+        m_tracker.assert_called_once_with(
+            "watcher-test", None, info=mock.ANY, track_memory=True)
+
+        self.config(enabled=False, group='profiler')
+        execute(mock.sentinel.audit)
+        self.assertEqual(1, m_tracker.call_count)
+
+
+class TestTraceWithMemory(ProfilerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config(enabled=True, group='profiler')
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_nested_calls_inherit_audit_id(self, m_profiler):
+        @profiler.trace_with_memory("watcher-inner")
+        def inner():
+            return profiler._AUDIT_ID.get()
+
+        @profiler.trace_with_memory(
+            "watcher-outer", info=lambda: {"audit_id": "fake_uuid"})
+        def outer():
+            return inner()
+
+        self.assertEqual("fake_uuid", outer())
+        self.assertIsNone(profiler._AUDIT_ID.get())
+
+    @mock.patch.object(profiler, '_is_sampled', return_value=False)
+    @mock.patch.object(profiler, 'profiler')
+    def test_nested_calls_other_audit(self, m_profiler, m_is_sampled):
+        @profiler.trace_with_memory(
+            "watcher-inner", info=lambda audit: {"audit_id": audit})
+        def inner(audit):
+            return profiler._AUDIT_ID.get()
+
+        @profiler.trace_with_memory(
+            "watcher-outer", info=lambda: {"audit_id": "audit_a"})
+        def outer():
+            return inner("audit_b"), profiler._AUDIT_ID.get()
+
+        self.assertEqual(("audit_b", "audit_a"), outer())
+        m_is_sampled.assert_has_calls([
+            mock.call("watcher-outer", "audit_a"),
+            mock.call("watcher-inner", "audit_b")])
+        self.assertIsNone(profiler._AUDIT_ID.get())
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_keyword_arguments(self, m_profiler):
+        @profiler.trace_with_memory("watcher-test")
+        def execute(audit, request_context):
+            return audit, request_context
+
+        self.assertEqual((1, 2), execute(1, 2))
+        self.assertEqual((1, 2), execute(1, request_context=2))
+        m_profiler.start.assert_called_with(
+            "watcher-test", info=mock.ANY)
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_decorated_function(self, m_profiler):
+        def inject_context(func):
+            @functools.wraps(func)
+            def inner(audit):
+                return func(audit, mock.sentinel.context)
+            return inner
+
+        @profiler.trace_with_memory("watcher-test")
+        @inject_context
+        def execute(audit, request_context):
+            return audit, request_context
+
+        self.assertEqual((1, mock.sentinel.context), execute(1))
+        self.assertEqual((1, mock.sentinel.context), execute(audit=1))
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_variadic_function(self, m_profiler):
+        @profiler.trace_with_memory("watcher-test")
+        def execute(*args, **kwargs):
+            return args, kwargs
+
+        self.assertEqual(((1,), {'foo': 2}), execute(1, foo=2))
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_constant_info(self, m_profiler):
+        info = {"audit_id": "fake_uuid"}
+
+        @profiler.trace_with_memory("watcher-test", info=info)
+        def execute(audit, foo=None):
+            return profiler._AUDIT_ID.get()
+
+        self.assertEqual("fake_uuid", execute(1, foo=2))
+        m_profiler.start.assert_called_once_with(
+            "watcher-test", info={
+                "audit_id": "fake_uuid",
+                "function": {
+                    "name": reflection.get_callable_name(execute),
+                    "args": "(1,)",
+                    "kwargs": "{'foo': 2}",
+                }})
+        self.assertEqual({"audit_id": "fake_uuid"}, info)
+
+    @mock.patch.object(profiler, 'profiler')
+    def test_exception(self, m_profiler):
+        @profiler.trace_with_memory("watcher-test")
+        def execute():
+            raise exception.ActionPlanIsOngoing(action_plan="fake_uuid")
+
+        self.assertRaises(exception.ActionPlanIsOngoing, execute)
+        stop_info = m_profiler.stop.call_args[0][0]
+        self.assertEqual("watcher.common.exception.ActionPlanIsOngoing",
+                         stop_info["etype"])
+
+
+class TestTraceEmitter(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.MockPatchObject(profiler, '_EMITTER', None))
+        # Notifications are only delivered by explicit flushes
+        self.useFixture(fixtures.MockPatchObject(
+            profiler._TraceEmitter, '_start_thread'))
+
+    @mock.patch('osprofiler.notifier.set')
+    @mock.patch('osprofiler.notifier.get')
+    def test_enable_deferred_emission(self, m_get, m_set):
+        profiler.enable_deferred_emission()
+        emitter = m_set.call_args[0][0]
+        self.assertIsInstance(emitter, profiler._TraceEmitter)
+        self.assertIs(emitter, profiler._EMITTER)
+
+        # The notifier is only wrapped once
+        m_get.return_value = emitter
+        profiler.enable_deferred_emission()
+        self.assertEqual(1, m_set.call_count)
+
+    def test_flush(self):
+        notify = mock.Mock()
+        emitter = profiler._TraceEmitter(notify)
+        emitter({"name": "foo-start"})
+        emitter({"name": "foo-stop"})
+        notify.assert_not_called()
+
+        profiler._EMITTER = emitter
+        profiler.flush_deferred_emission()
+        notify.assert_has_calls([mock.call({"name": "foo-start"}),
+                                 mock.call({"name": "foo-stop"})])
+
+    @mock.patch.object(profiler, 'LOG')
+    def test_flush_notify_error(self, m_log):
+        notify = mock.Mock(side_effect=[Exception("boom"), None])
+        emitter = profiler._TraceEmitter(notify)
+        emitter({"name": "foo-start"})
+        emitter({"name": "foo-stop"})
+        emitter.flush()
+        self.assertEqual(2, notify.call_count)
+        m_log.warning.assert_called_once_with(
+            "Failed to emit profiler trace: %s", mock.ANY)
+
+    @mock.patch.object(profiler, 'LOG')
+    @mock.patch.object(profiler._TraceEmitter, 'MAX_PENDING', 1)
+    def test_dropped_notifications(self, m_log):
+        notify = mock.Mock()
+        emitter = profiler._TraceEmitter(notify)
+        emitter({"name": "foo-start"})
+        emitter({"name": "foo-stop"})
+        emitter.flush()
+        notify.assert_called_once_with({"name": "foo-start"})
+        m_log.warning.assert_called_once_with(
+            "Dropped %d profiler notifications, more than %d were pending",
+            1, 1)
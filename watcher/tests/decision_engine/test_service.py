@@ -14,6 +14,7 @@
 
 from unittest import mock
 
+from watcher.common import profiler as watcher_profiler
 from watcher.common import service as watcher_service
 from watcher.decision_engine.audit import continuous as c_handler
 from watcher.decision_engine import scheduling
@@ -42,15 +43,34 @@ class TestDecisionEngineService(base.TestCase):
         sch_start.assert_called()
         cont_audit_start.assert_called()
 
+    @mock.patch.object(watcher_profiler, 'enable_deferred_emission')
+    @mock.patch('osprofiler.initializer.init_from_conf')
+    @mock.patch.object(c_handler.ContinuousAuditHandler, 'start')
+    @mock.patch.object(scheduling.DecisionEngineSchedulingService, 'start')
+    @mock.patch.object(watcher_service.Service, 'start')
+    def test_decision_engine_service_start_profiler(
+            self, svc_start, sch_start, cont_audit_start, m_init_from_conf,
+            m_enable_deferred, svc_init, sch_init):
+        self.config(enabled=True, group='profiler')
+        de_service = service.DecisionEngineService()
+        de_service.start()
+
+        m_init_from_conf.assert_called_once_with(
+            conf=service.CONF, context=mock.ANY, project="watcher",
+            service="decision-engine", host=service._HOSTNAME)
+        m_enable_deferred.assert_called_once_with()
+
+    @mock.patch.object(watcher_profiler, 'flush_deferred_emission')
     @mock.patch.object(scheduling.DecisionEngineSchedulingService, 'stop')
     @mock.patch.object(watcher_service.Service, 'stop')
     def test_decision_engine_service_stop(self, svc_stop, sch_stop,
-                                          svc_init, sch_init):
+                                          m_flush, svc_init, sch_init):
         de_service = service.DecisionEngineService()
         de_service.stop()
 
         svc_stop.assert_called()
         sch_stop.assert_called()
+        m_flush.assert_called_once_with()
 
     @mock.patch.object(scheduling.DecisionEngineSchedulingService, 'wait')
     @mock.patch.object(watcher_service.Service, 'wait')